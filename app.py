@@ -1,34 +1,64 @@
 import sys
 import os
-import io
-import urllib.parse
-from PIL import Image
-from PySide6.QtCore import QObject, Signal, QUrl, Qt, QPoint, QRect, QSize, Slot, QDir
-from PySide6.QtGui import QGuiApplication, QScreen, QPixmap, QPainter, QColor, QCursor
+import logging
+import asyncio
+import threading
+import hashlib
+import functools
+from collections import OrderedDict
+from PySide6.QtCore import QObject, Signal, QUrl, Qt, QPoint, QRect, QSize, Slot, QBuffer, QByteArray, QIODevice, QTimer
+from PySide6.QtGui import QGuiApplication, QScreen, QPixmap, QPainter, QCursor, QRegion
 from PySide6.QtQml import QQmlApplicationEngine
+from PySide6.QtQuick import QQuickImageProvider
 from PySide6.QtWidgets import QApplication, QWidget
 import google.generativeai as genai
 from dotenv import load_dotenv
 
 load_dotenv()
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-
-def perform_ocr_with_gemini(image_data, gemini_api_key):
-    try:
-        genai.configure(api_key=gemini_api_key)
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        image = Image.open(io.BytesIO(image_data))
-        contents = [
-            "What text is in this image?",
-            image
-        ]
-        response = model.generate_content(contents)
-        extracted_text = response.text
-        return extracted_text
+logger = logging.getLogger(__name__)
 
-    except Exception as e:
-        return f"Error during OCR: {e}"
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+genai.configure(api_key=GOOGLE_API_KEY)
+_MODEL = genai.GenerativeModel(
+    'gemini-2.0-flash',
+    system_instruction=(
+        "You are a strict OCR engine. Transcribe the text in the image exactly, "
+        "preserving line breaks. Never add commentary, descriptions or formatting."
+    ),
+)
+# Deterministic, plain-text output with a cap; output tokens dominate wall time after the upload.
+_GENERATION_CONFIG = {
+    "temperature": 0,
+    "max_output_tokens": 8192,
+    "response_mime_type": "text/plain",
+}
+
+MAX_CONCURRENT_OCR = 5
+OCR_CACHE_SIZE = 128
+OCR_MAX_EDGE = 1024
+OCR_JPEG_QUALITY = 85
+OCR_MIME_TYPE = "image/jpeg"
+REPAINT_INTERVAL_MS = 16
+CAPTURE_DELAY_MS = 100
+
+async def perform_ocr_with_gemini(image_data, mime_type=OCR_MIME_TYPE):
+    # The SDK accepts encoded bytes as an inline part, so there is no need to decode them here.
+    contents = [
+        "Transcribe all visible text exactly. Output only the text, no commentary.",
+        {"mime_type": mime_type, "data": image_data}
+    ]
+    response = await _MODEL.generate_content_async(contents, generation_config=_GENERATION_CONFIG)
+    # A response stopped at the token cap still has text; raise so partial output is never shown or cached.
+    if response.candidates and response.candidates[0].finish_reason == genai.protos.Candidate.FinishReason.MAX_TOKENS:
+        raise RuntimeError("the text in this capture exceeds the output token limit")
+    extracted_text = response.text
+    return extracted_text
+
+
+def ocr_cache_key(image_data):
+    # Only an exact byte match is safe to reuse: visually similar captures can differ by one character.
+    return hashlib.blake2b(image_data, digest_size=16).digest()
 
 
 class SnippingTool(QObject):
@@ -36,6 +66,7 @@ class SnippingTool(QObject):
     ocrResultReady = Signal(str)
     captureStarted = Signal()
     captureEnded = Signal()
+    _ocrFinished = Signal(int, str)
 
     def __init__(self):
         super().__init__()
@@ -43,7 +74,18 @@ class SnippingTool(QObject):
         self.end_pos = None
         self.is_snipping = False
         self.overlay_window = None
-        self.gemini_api_key = os.environ.get("GOOGLE_API_KEY")
+        self.screenshot = None
+        self.screenshot_data = None
+        self._capture_id = 0
+        self._scratch = QByteArray()
+
+        self._ocrFinished.connect(self._deliver_ocr_result, Qt.QueuedConnection)
+        self._loop = asyncio.new_event_loop()
+        self._ocr_cache = OrderedDict()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        # Built on the loop's own thread: before Python 3.10 a semaphore binds to the loop current at creation.
+        self._sem = asyncio.run_coroutine_threadsafe(self._create_semaphore(), self._loop).result()
 
     @Slot()
     def start_capture(self):
@@ -51,7 +93,7 @@ class SnippingTool(QObject):
         self.captureStarted.emit()
         self.start_pos = None
         self.end_pos = None
-        self.overlay_window = FullScreenOverlay(self)
+        self.overlay_window = FullScreenOverlayWidget(self)
         self.overlay_window.showFullScreen()
         QApplication.setOverrideCursor(Qt.CrossCursor)
 
@@ -60,13 +102,19 @@ class SnippingTool(QObject):
         self.is_snipping = False
         self.captureEnded.emit()
         QApplication.restoreOverrideCursor()
+        start_pos, end_pos = self.start_pos, self.end_pos
         if self.overlay_window:
+            # Selection positions are overlay-local; capture works in global desktop coordinates.
+            if start_pos and end_pos:
+                start_pos = self.overlay_window.mapToGlobal(start_pos)
+                end_pos = self.overlay_window.mapToGlobal(end_pos)
             self.overlay_window.close()
             self.overlay_window = None
 
-        if self.start_pos and self.end_pos:
-            rect = QRect(self.start_pos, self.end_pos).normalized()
-            self.capture_region(rect)
+        if start_pos and end_pos:
+            rect = QRect(start_pos, end_pos).normalized()
+            # Give the window system time to take the overlay off screen before grabbing.
+            QTimer.singleShot(CAPTURE_DELAY_MS, lambda: self.capture_region(rect))
 
     def mouse_press_event(self, event):
         if self.is_snipping:
@@ -75,7 +123,6 @@ class SnippingTool(QObject):
     def mouse_move_event(self, event):
         if self.is_snipping and self.start_pos:
             self.end_pos = event.pos()
-            self.overlay_window.update()
 
     def mouse_release_event(self, event):
         if self.is_snipping and self.start_pos:
@@ -83,51 +130,104 @@ class SnippingTool(QObject):
             self.end_capture()
 
     def capture_region(self, rect):
-        screen = QGuiApplication.primaryScreen()
+        # Grab from the monitor the selection is on, in that screen's local coordinates.
+        screen = QGuiApplication.screenAt(rect.center()) or QGuiApplication.primaryScreen()
         if screen is None:
-            print("No screen found.")
+            logger.warning("No screen found.")
             return
 
-        pixmap = screen.grabWindow(0, rect.x(), rect.y(), rect.width(), rect.height())
+        local_rect = rect.translated(-screen.geometry().topLeft())
+        pixmap = screen.grabWindow(0, local_rect.x(), local_rect.y(), local_rect.width(), local_rect.height())
         if pixmap.isNull():
-            print("Failed to grab screenshot.")
+            logger.warning("Failed to grab screenshot.")
             return
 
-        temp_file = "screenshot.png"
-        pixmap.save(temp_file, "PNG")
+        # Fewer pixels means a smaller upload and fewer vision tokens; the preview keeps full resolution.
+        ocr_pixmap = pixmap
+        if max(pixmap.width(), pixmap.height()) > OCR_MAX_EDGE:
+            ocr_pixmap = pixmap.scaled(OCR_MAX_EDGE, OCR_MAX_EDGE, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+        # Reuse one encode buffer across captures; truncate keeps its allocated capacity.
+        self._scratch.truncate(0)
+        buffer = QBuffer(self._scratch)
+        buffer.open(QIODevice.WriteOnly)
+        # JPEG encodes faster and uploads far smaller than PNG; q85 keeps rendered text sharp.
+        ocr_pixmap.save(buffer, "JPEG", OCR_JPEG_QUALITY)
+        buffer.close()
+
+        self.screenshot = pixmap
+        self.screenshot_data = bytes(buffer.data())
+        # A fresh id per capture keeps QML from showing a stale preview.
+        self._capture_id += 1
+        self.screenshotReady.emit(f"image://screenshot/{self._capture_id}")
 
-        absolute_path = os.path.abspath(temp_file)
-        local_path = QDir.toNativeSeparators(absolute_path)
+    @Slot()
+    def process_ocr(self):
+        if self.screenshot_data is None:
+            self.ocrResultReady.emit("Error processing OCR: no screenshot captured.")
+            return
 
-        self.screenshotReady.emit(local_path)
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._run_ocr(self.screenshot_data), self._loop)
+            future.add_done_callback(functools.partial(self._on_ocr_done, self._capture_id))
+        except Exception as e:
+            self.ocrResultReady.emit(f"Error processing OCR: {e}")
 
-    @Slot(str)
-    def process_ocr(self, image_path):
+    async def _create_semaphore(self):
+        return asyncio.Semaphore(MAX_CONCURRENT_OCR)
+
+    async def _run_ocr(self, image_data):
+        key = ocr_cache_key(image_data)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
+        # Bounds in-flight Gemini requests; each capture is its own task, so a failure stays isolated.
+        async with self._sem:
+            try:
+                ocr_result = await perform_ocr_with_gemini(image_data)
+            except Exception as e:
+                return f"Error during OCR: {e}"
+
+        self._cache_put(key, ocr_result)
+        return ocr_result
+
+    # The OCR cache is only touched from the asyncio thread.
+    def _cache_get(self, key):
+        ocr_result = self._ocr_cache.get(key)
+        if ocr_result is not None:
+            self._ocr_cache.move_to_end(key)
+        return ocr_result
+
+    def _cache_put(self, key, ocr_result):
+        self._ocr_cache[key] = ocr_result
+        while len(self._ocr_cache) > OCR_CACHE_SIZE:
+            self._ocr_cache.popitem(last=False)
+
+    def _on_ocr_done(self, capture_id, future):
+        # Runs on the asyncio thread; the queued connection hands the result to the Qt thread.
         try:
-            path_part = image_path.replace("file:///", "")
-            decoded_path = urllib.parse.unquote(path_part)
-            with open(decoded_path, "rb") as image_file:
-                image_data = image_file.read()
+            self._ocrFinished.emit(capture_id, future.result())
+        except Exception as e:
+            self._ocrFinished.emit(capture_id, f"Error processing OCR: {e}")
 
-            ocr_result = perform_ocr_with_gemini(image_data, self.gemini_api_key)
+    @Slot(int, str)
+    def _deliver_ocr_result(self, capture_id, ocr_result):
+        # Requests finish out of order; only show the result for the capture on screen.
+        if capture_id == self._capture_id:
             self.ocrResultReady.emit(ocr_result)
-        except Exception as e:
-            self.ocrResultReady.emit(f"Error processing OCR: {e}")
 
-class FullScreenOverlay(QObject):
+class ScreenshotProvider(QQuickImageProvider):
     def __init__(self, snipping_tool):
-        super().__init__()
+        super().__init__(QQuickImageProvider.Pixmap)
         self.snipping_tool = snipping_tool
-        self.widget = FullScreenOverlayWidget(snipping_tool)
 
-    def showFullScreen(self):
-        self.widget.showFullScreen()
+    def requestPixmap(self, id, size, requestedSize):
+        pixmap = self.snipping_tool.screenshot
+        if pixmap is None:
+            return QPixmap()
+        return pixmap
 
-    def close(self):
-        self.widget.close()
-
-    def update(self):
-        self.widget.update()
 
 class FullScreenOverlayWidget(QWidget):
     def __init__(self, snipping_tool):
@@ -135,22 +235,47 @@ class FullScreenOverlayWidget(QWidget):
         self.setWindowFlag(Qt.FramelessWindowHint)
         self.setWindowState(Qt.WindowFullScreen)
         self.setWindowFlags(Qt.FramelessWindowHint)
-        self.setAttribute(Qt.WA_TranslucentBackground)
-        self.setStyleSheet("background:transparent;")
+        # An opaque window dimmed by the compositor avoids per-pixel ARGB blending in the raster engine.
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+        self.setWindowOpacity(0.5)
         self.snipping_tool = snipping_tool
         self.start_pos = None
         self.end_pos = None
+        self._last_selection_rect = QRect()
+        self._dirty_rect = QRect()
+        # Mice report far faster than the display refreshes; coalesce moves into one repaint per frame.
+        self._repaint_timer = QTimer(self)
+        self._repaint_timer.setSingleShot(True)
+        self._repaint_timer.setInterval(REPAINT_INTERVAL_MS)
+        self._repaint_timer.timeout.connect(self._flush_repaint)
         self.setCursor(Qt.CrossCursor)
 
     def mousePressEvent(self, event):
         self.snipping_tool.mouse_press_event(event)
         self.start_pos = event.pos()
+        self._last_selection_rect = QRect()
+        self.clearMask()
         self.update()
 
     def mouseMoveEvent(self, event):
         self.snipping_tool.mouse_move_event(event)
-        self.end_pos = event.pos()
-        self.update()
+        start_pos = self.start_pos
+        end_pos = self.end_pos = event.pos()
+        if start_pos is None:
+            return
+        # Only the area covered by the old and new selection changes between frames.
+        new_rect = QRect(start_pos, end_pos).normalized()
+        dirty_rect = new_rect.united(self._last_selection_rect).adjusted(-2, -2, 2, 2)
+        self._dirty_rect = self._dirty_rect.united(dirty_rect)
+        self._last_selection_rect = new_rect
+        if not self._repaint_timer.isActive():
+            self._repaint_timer.start()
+
+    def _flush_repaint(self):
+        # Cut the selection out of the window so it shows the desktop undimmed.
+        self.setMask(QRegion(self.rect()).subtracted(QRegion(self._last_selection_rect)))
+        self.update(self._dirty_rect)
+        self._dirty_rect = QRect()
 
     def mouseReleaseEvent(self, event):
         self.snipping_tool.mouse_release_event(event)
@@ -160,15 +285,8 @@ class FullScreenOverlayWidget(QWidget):
     def paintEvent(self, event):
         painter = QPainter(self)
         painter.setRenderHint(QPainter.Antialiasing)
-        painter.fillRect(self.rect(), Qt.transparent)
-        painter.setBrush(QColor(0, 0, 0, 128))
-        painter.setPen(Qt.NoPen)
-        painter.drawRect(self.rect())
-
-        if self.snipping_tool.start_pos and self.snipping_tool.end_pos:
-            selection_rect = QRect(self.snipping_tool.start_pos, self.snipping_tool.end_pos).normalized()
-            painter.setCompositionMode(QPainter.CompositionMode_Clear)
-            painter.drawRect(selection_rect)
+        # The selection itself is masked out of the window in _flush_repaint.
+        painter.fillRect(event.rect(), Qt.black)
 
 
 if __name__ == "__main__":
@@ -176,7 +294,9 @@ if __name__ == "__main__":
     engine = QQmlApplicationEngine()
 
     snipping_tool = SnippingTool()
+    screenshot_provider = ScreenshotProvider(snipping_tool)
 
+    engine.addImageProvider("screenshot", screenshot_provider)
     engine.rootContext().setContextProperty("snippingTool", snipping_tool)
 
     engine.load(QUrl("main.qml"))
@@ -43,7 +43,8 @@ ApplicationWindow {
 
         Image {
             id: capturedImage
-            source: ""  // Will be populated with the image path
+            source: ""  // Will be populated with the image provider URL
+            cache: false
             Layout.alignment: Qt.AlignHCenter
             Layout.fillWidth: true
             Layout.fillHeight: true
@@ -55,7 +56,7 @@ ApplicationWindow {
             id: ocrButton
             text: "Process OCR"
             onClicked: {
-                snippingTool.process_ocr(capturedImage.source.toString()); // Path to file
+                snippingTool.process_ocr();
             }
             enabled: capturedImage.source !== ""
         }
@@ -72,9 +73,9 @@ ApplicationWindow {
     Connections {
         target: snippingTool
 
-        function onScreenshotReady(imagePath) {
-          console.log ("File Path from local: " + imagePath);
-          capturedImage.source = "file:///" + imagePath;
+        function onScreenshotReady(imageUrl) {
+          console.log ("Screenshot URL: " + imageUrl);
+          capturedImage.source = imageUrl;
         }
 
         function onOcrResultReady(result) {